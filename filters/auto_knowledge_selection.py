@@ -1,45 +1,109 @@
+import asyncio
+import codecs
+import hashlib
 import json
+import logging
 import re
-from pydantic import BaseModel, Field
+import time
+from collections import OrderedDict
+import numpy as np
+from pydantic import BaseModel, Field, TypeAdapter
 from typing import Callable, Awaitable, Any, Optional
 
 from open_webui.models.users import Users, UserModel
 from open_webui.utils.chat import generate_chat_completion
 from open_webui.utils.misc import get_last_user_message
 from open_webui.models.knowledge import Knowledges
-from open_webui.models.files import Files
+from open_webui.models.files import Files, FileMetadataResponse
 from open_webui.utils.middleware import chat_web_search_handler
+from open_webui.env import SRC_LOG_LEVELS
+
+log = logging.getLogger(__name__)
+log.setLevel(SRC_LOG_LEVELS["MAIN"])
+
+try:
+    import orjson
+
+    # orjson.JSONDecodeError subclasses json.JSONDecodeError, so callers catch either.
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+_JSON_OBJ_RE = re.compile(r"\{.*?\}", re.DOTALL)
+_NONE_RE = re.compile(r"^\s*none\s*$", re.IGNORECASE)
+_FILES_ADAPTER = TypeAdapter(list[FileMetadataResponse])
+
+_CONTEXT_MESSAGE = {
+    "role": "system",
+    "content": (
+        "You are ChatGPT, a large language model trained by OpenAI. "
+        "Please ensure that all your responses are presented in a clear and organized manner using bullet points, numbered lists, headings, and other formatting tools to enhance readability and user-friendliness. "
+        "Additionally, please respond in the language used by the user in their input. "
+    ),
+}
+
+_WORD_RE = re.compile(r"\w+")
+_YEAR_RE = re.compile(r"\b(?:19|20)\d{2}\b")
+# Only unambiguous keywords short-circuit the LLM; anything else is left to the classifier
+_WEB_SEARCH_YES_KEYWORDS = frozenset(
+    {"today", "yesterday", "latest", "news", "weather", "breaking"}
+)
+_WEB_SEARCH_NO_KEYWORDS = frozenset({"translate"})
+
+
+def guess_web_search_needed(user_message: str) -> Optional[bool]:
+    """
+    Cheaply decide whether a web search is needed using keywords.
+    - Returns True if only "fresh information" keywords (or the current year or later) appear.
+    - Returns False if only "no search" keywords appear.
+    - Returns None when neither or both appear, so the LLM should decide.
+    """
+    text = user_message.lower()
+    words = set(_WORD_RE.findall(text))
+
+    current_year = time.localtime().tm_year
+    needs_search = not words.isdisjoint(_WEB_SEARCH_YES_KEYWORDS) or any(
+        int(year) >= current_year for year in _YEAR_RE.findall(text)
+    )
+    no_search = not words.isdisjoint(_WEB_SEARCH_NO_KEYWORDS)
+
+    if needs_search != no_search:
+        return needs_search
+    return None
 
 
 def parse_json_content(content: str) -> Optional[dict]:
     """
     Extract a JSON object from the given string and convert it to a dict.
-    - If the entire string is enclosed in '{...}', attempt to parse it directly.
-    - Otherwise, use a regular expression to extract the first JSON object and attempt to parse it.
-    - If parsing fails, return None.
-    - If necessary (when parsing fails), also try replacing single quotes (') with double quotes (") and retry.
+    - First, attempt to parse the whole string as a JSON object (the common case).
+    - Return None for non-JSON strings like "None".
+    - If the entire string is enclosed in '{...}', retry with single quotes (') replaced by double quotes (").
+    - Otherwise, use a regular expression to extract the first JSON object and parse it,
+      retrying with single quotes replaced by double quotes if that fails.
+    - If parsing still fails, return None.
     """
 
     def try_load_json(json_str: str) -> Optional[dict]:
         """Attempt to parse the given json_str and return None if parsing fails."""
         try:
-            return json.loads(json_str)
+            return _json_loads(json_str)
         except json.JSONDecodeError:
             return None
 
+    # 0) Fast path: the response is already a valid JSON object
+    parsed_data = try_load_json(content)
+    if isinstance(parsed_data, dict):
+        return parsed_data
+
     content = content.strip()
 
     # Handle specific non-JSON strings like "None"
-    if content.lower() == "none":
+    if _NONE_RE.match(content):
         return None
 
     # 1) Check if the string is directly enclosed in '{...}'
     if content.startswith("{") and content.endswith("}"):
-        parsed_data = try_load_json(content)
-        if parsed_data is not None:
-            return parsed_data
-
-        # If parsing fails, try replacing single quotes with double quotes and retry
+        # Direct parsing already failed above, so try replacing single quotes with double quotes
         content_single_to_double = content.replace("'", '"')
         parsed_data = try_load_json(content_single_to_double)
         if parsed_data is not None:
@@ -48,7 +112,7 @@ def parse_json_content(content: str) -> Optional[dict]:
         return None
 
     # 2) Extract '{...}' pattern using a regular expression
-    match = re.search(r"\{.*?\}", content, flags=re.DOTALL)
+    match = _JSON_OBJ_RE.search(content)
     if not match:
         return None
 
@@ -67,13 +131,334 @@ def parse_json_content(content: str) -> Optional[dict]:
     return None
 
 
+async def read_completion_content(response: Any) -> str:
+    """
+    Return the message content of a chat completion response.
+    - Non-streaming responses are read directly.
+    - Streaming (SSE) responses are read chunk by chunk, and the stream is closed as soon as the
+      first JSON object in the content is complete. In that case only the JSON object is returned.
+    - If no JSON object is completed before the stream ends, the full content is returned.
+    """
+    if isinstance(response, dict):
+        return response["choices"][0]["message"]["content"]
+
+    body_iterator = getattr(response, "body_iterator", None)
+    if body_iterator is None:
+        return ""
+
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+    content = ""
+    pending = ""
+    scanned = 0
+    start = 0
+    depth = 0
+    in_string = False
+    escaped = False
+    try:
+        async for chunk in body_iterator:
+            if isinstance(chunk, bytes):
+                chunk = decoder.decode(chunk)
+            lines = (pending + chunk).split("\n")
+            pending = lines.pop()
+
+            for line in lines:
+                line = line.strip()
+                if not line.startswith("data:") or line == "data: [DONE]":
+                    continue
+                try:
+                    delta = _json_loads(line[5:])["choices"][0]["delta"]
+                except (ValueError, KeyError, IndexError, TypeError):
+                    continue
+                content += delta.get("content") or ""
+
+            # Track brace depth (ignoring braces inside strings) to find where the object closes
+            for index in range(scanned, len(content)):
+                char = content[index]
+                if depth == 0:
+                    if char == "{":
+                        start, depth = index, 1
+                elif in_string:
+                    if escaped:
+                        escaped = False
+                    elif char == "\\":
+                        escaped = True
+                    elif char == '"':
+                        in_string = False
+                elif char == '"':
+                    in_string = True
+                elif char == "{":
+                    depth += 1
+                elif char == "}":
+                    depth -= 1
+                    if depth == 0:
+                        return content[start : index + 1]
+            scanned = len(content)
+    finally:
+        aclose = getattr(body_iterator, "aclose", None)
+        if aclose is not None:
+            await aclose()
+        # The response is never sent, so run its cleanup (e.g. closing the upstream session) here
+        background = getattr(response, "background", None)
+        if background is not None:
+            await background()
+
+    return content
+
+
+class TTLCache:
+    """
+    A small cache whose entries expire after `ttl` seconds.
+    - Entries are kept in insertion order, so expired entries are evicted from the front.
+    - Beyond `maxsize` entries, the oldest ones are evicted as well.
+    """
+
+    def __init__(self, ttl: float, maxsize: int = 1024):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries: OrderedDict[Any, tuple[float, Any]] = OrderedDict()
+
+    def _evict_expired(self) -> None:
+        now = time.monotonic()
+        while self._entries and now - next(iter(self._entries.values()))[0] >= self.ttl:
+            self._entries.popitem(last=False)
+
+    def get(self, key: Any) -> Any:
+        """Return the value cached under `key`, or None if it is missing or expired."""
+        self._evict_expired()
+        entry = self._entries.get(key)
+        return entry[1] if entry is not None else None
+
+    def set(self, key: Any, value: Any) -> None:
+        self._evict_expired()
+        self._entries.pop(key, None)
+        while len(self._entries) >= self.maxsize:
+            self._entries.popitem(last=False)
+        self._entries[key] = (time.monotonic(), value)
+
+    def values(self) -> list:
+        """Return all values that have not expired, oldest first."""
+        self._evict_expired()
+        return [value for _, value in self._entries.values()]
+
+
+class SemanticCache:
+    """
+    Cache classifier results so repeated or paraphrased queries skip the LLM round-trip.
+    - Each entry belongs to an `llm_string`, which identifies the model, the classifier
+      and anything else the result depends on (e.g. the set of knowledge bases).
+    - An exact match on the normalized query (md5) is checked first.
+    - Otherwise, if an embedding of the query is given (see `aembed`), the most similar cached
+      query with the same `llm_string` above the cosine threshold is returned (a single matrix product).
+    - Entries expire after `ttl` seconds, and at most `maxsize` entries are kept.
+    """
+
+    def __init__(self, maxsize: int = 256):
+        # Entries hold embedding vectors, so keep far fewer than the default
+        self.maxsize = maxsize
+        self._entries = TTLCache(ttl=3600, maxsize=maxsize)
+
+    @staticmethod
+    def _hash(prompt: str) -> str:
+        return hashlib.md5(" ".join(prompt.lower().split()).encode()).hexdigest()
+
+    @staticmethod
+    async def aembed(prompt: str, embed_fn: Optional[Callable]) -> Optional[np.ndarray]:
+        """Embed and normalize the prompt, or return None if that is not possible."""
+        if embed_fn is None:
+            return None
+        try:
+            if asyncio.iscoroutinefunction(embed_fn):
+                vector = await embed_fn(prompt)
+            else:
+                vector = await asyncio.to_thread(embed_fn, prompt)
+        except Exception as e:
+            log.warning("Embedding failed, using exact-match cache only: %s", e)
+            return None
+        if vector is None or len(vector) == 0:
+            return None
+
+        vector = np.asarray(vector, dtype=np.float32).ravel()
+        norm = np.linalg.norm(vector)
+        if not norm:
+            return None
+        vector /= norm
+        return vector
+
+    async def alookup(
+        self,
+        prompt: str,
+        llm_string: str,
+        ttl: float,
+        threshold: float,
+        vector_task: Optional[Awaitable] = None,
+    ) -> Optional[dict]:
+        self._entries.ttl = ttl
+
+        prompt_hash = self._hash(prompt)
+        entry = self._entries.get((llm_string, prompt_hash))
+        if entry is not None:
+            return entry[2]
+
+        candidates = [
+            (cached_vector, result)
+            for cached_llm_string, cached_vector, result in self._entries.values()
+            if cached_llm_string == llm_string and cached_vector is not None
+        ]
+        if not candidates:
+            return None
+
+        vector = await vector_task if vector_task is not None else None
+        if vector is None:
+            return None
+
+        matrix = np.stack([cached_vector for cached_vector, _ in candidates])
+        if matrix.shape[1] != vector.shape[0]:
+            return None
+        scores = matrix @ vector
+        best = int(np.argmax(scores))
+        return candidates[best][1] if scores[best] >= threshold else None
+
+    async def aupdate(
+        self,
+        prompt: str,
+        llm_string: str,
+        result: dict,
+        ttl: float,
+        vector_task: Optional[Awaitable] = None,
+    ) -> None:
+        self._entries.ttl = ttl
+
+        prompt_hash = self._hash(prompt)
+        vector = await vector_task if vector_task is not None else None
+        self._entries.set((llm_string, prompt_hash), (llm_string, vector, result))
+
+
+_classifier_cache = SemanticCache()
+# Keep references to pending cache updates so they are not garbage collected
+_background_tasks: set[asyncio.Task] = set()
+
+
+def hash_history(messages: list[dict]) -> str:
+    """
+    Return a hash of the earlier messages the classifier sees alongside the user query.
+    - Used in the cache key, so follow-ups like "tell me more" only hit results from the same context.
+    """
+    return hashlib.md5(
+        "\n".join(
+            f"{message.get('role')}: {message.get('content')}" for message in messages
+        ).encode()
+    ).hexdigest()
+
+
+_KB_CACHE_TTL = 60
+_kb_cache = TTLCache(ttl=_KB_CACHE_TTL)
+
+
+def get_knowledge_bases_cached(
+    user_id: str, permission: str, refresh: bool = False
+) -> tuple[dict, str, str, bool]:
+    """
+    Return the knowledge bases accessible by the user, reusing results for `_KB_CACHE_TTL` seconds.
+    - Returns a tuple of (knowledge bases keyed by ID, formatted list for the prompt, hash of the IDs,
+      whether they were just loaded from the database).
+    - Cached entries can be stale (e.g. file lists and access), so pass `refresh=True` to reload
+      them in a single query before relying on anything beyond the prompt and ID lookup.
+    """
+    key = (user_id, permission)
+    cached = None if refresh else _kb_cache.get(key)
+    if cached:
+        return (*cached, False)
+
+    all_knowledge_bases = Knowledges.get_knowledge_bases_by_user_id(user_id, permission)
+
+    knowledge_bases_list = "\n\n".join(
+        [
+            f"--- Knowledge Base {index + 1} ---\n"
+            f"ID: {getattr(knowledge_base, 'id', 'Unknown')}\n"
+            f"Name: {getattr(knowledge_base, 'name', 'Unknown')}\n"
+            f"Description: {getattr(knowledge_base, 'description', 'Unknown')}"
+            for index, knowledge_base in enumerate(all_knowledge_bases)
+        ]
+    )
+
+    kb_ids_hash = hashlib.md5(
+        ",".join(
+            sorted(
+                str(getattr(knowledge_base, "id", ""))
+                for knowledge_base in all_knowledge_bases
+            )
+        ).encode()
+    ).hexdigest()
+
+    knowledge_bases = {
+        knowledge_base.id: knowledge_base for knowledge_base in all_knowledge_bases
+    }
+
+    _kb_cache.set(key, (knowledge_bases, knowledge_bases_list, kb_ids_hash))
+    return knowledge_bases, knowledge_bases_list, kb_ids_hash, True
+
+
 class Filter:
     class Valves(BaseModel):
         status: bool = Field(default=True)
         auto_search_mode: bool = Field(default=False)
+        classifier_model: str = Field(default="gpt-4o-mini")
+        auto_select_single_knowledge_base: bool = Field(default=False)
+        stream_classifier: bool = Field(default=True)
+        web_search_keyword_check: bool = Field(default=True)
+        cache_enabled: bool = Field(default=True)
+        cache_ttl: int = Field(default=3600)
+        cache_similarity_threshold: float = Field(default=0.90)
 
     def __init__(self):
         self.valves = self.Valves()
+        self._kb_system_prompt_tpl = """You are a system that selects the most appropriate knowledge bases for the user's query.
+Below is a list of knowledge bases accessible by the user. 
+Based on the user's prompt, return the 1-3 most relevant knowledge bases as an array. 
+If no relevant knowledge bases are applicable, return an "None" without any explanation.
+
+Available knowledge bases:
+{kb_list}
+
+Return the result in the following JSON format (no extra keys, no explanations):
+{{
+    "selected_knowledge_bases": 
+        [
+            {{
+                "id": <KnowledgeBaseID>,
+                "name": <KnowledgeBaseName>
+            }},
+            ...
+        ]
+}}"""
+
+        self._ws_system_prompt = """You are a system that determines if a web search is needed for the user's query.
+
+Consider the following when making your decision:
+1. If the query relates to real-time or up-to-date information, including recurring events 
+   (e.g., a presidential inauguration, annual shareholder meetings, quarterly earnings reports, 
+   product launches, or company announcements), enable a web search to ensure the most recent 
+   occurrence is addressed.
+
+2. If the query is not about historical facts, assume most questions benefit from incorporating 
+   the latest information available through a web search.
+
+3. Particularly for questions regarding business or economic topics—such as company or 
+   industry trends, corporate information, related public figures, government policies, 
+   taxes, new technologies, and other fast-changing subjects—web search is strongly recommended 
+   to ensure accuracy and freshness of data.
+
+4. For general or everyday prompts that may require current information (e.g., weather updates, recent news, live events), enable a web search.
+
+5. Strive to make human-like judgments to ensure your decision aligns with the user's intent 
+   and the context of the question.
+
+6. If the user's query is not clear, return "None" without any explanation.
+
+Return the result in the following JSON format:
+{
+    "web_search_enabled": boolean
+}"""
 
     async def emit_status(
         self,
@@ -93,6 +478,77 @@ class Filter:
                 }
             )
 
+    async def run_plan(
+        self,
+        plan: dict,
+        user_message: Optional[str],
+        vector_task: Optional[Awaitable],
+        __request__: Any,
+        user: Any,
+    ) -> Optional[dict]:
+        """
+        Run a classifier plan against the LLM and return the parsed JSON result.
+        - Plans that already carry a resolved `result` are returned as-is without calling the LLM.
+        - When caching is enabled, a cached result for the same (or a similar) query is
+          returned without calling the LLM, and fresh results are stored in the cache.
+        - `vector_task` resolves to the embedding of `user_message` shared by all classifiers.
+        """
+        if "result" in plan:
+            return plan["result"]
+
+        # Without a user message there is nothing to key the cache on
+        use_cache = self.valves.cache_enabled and bool(user_message)
+
+        if use_cache:
+            cached = await _classifier_cache.alookup(
+                user_message,
+                plan["llm_string"],
+                ttl=self.valves.cache_ttl,
+                threshold=self.valves.cache_similarity_threshold,
+                vector_task=vector_task,
+            )
+            if cached is not None:
+                return cached
+
+        payload = {
+            "model": plan["model"],
+            "messages": [
+                {"role": "system", "content": plan["system_prompt"]},
+                {"role": "user", "content": plan["prompt"]},
+            ],
+            "stream": self.valves.stream_classifier,
+        }
+        response = await generate_chat_completion(
+            request=__request__, form_data=payload, user=user
+        )
+
+        content = await read_completion_content(response) if response else ""
+        log.debug("classifier content: %s", content)
+
+        # The classifiers answer "None" when nothing applies; treat (and cache) that as an
+        # explicit empty result, and only skip the cache for content that fails to parse
+        if content and _NONE_RE.match(content):
+            result = plan["none_result"]
+        else:
+            result = parse_json_content(content)
+
+        if result is not None and use_cache:
+            update = _classifier_cache.aupdate(
+                user_message,
+                plan["llm_string"],
+                result,
+                ttl=self.valves.cache_ttl,
+                vector_task=vector_task,
+            )
+            # Don't hold up the inlet if the embedding is still running
+            if vector_task is None or vector_task.done():
+                await update
+            else:
+                task = asyncio.ensure_future(update)
+                _background_tasks.add(task)
+                task.add_done_callback(_background_tasks.discard)
+        return result
+
     async def select_knowledge_base(
         self, body: dict, __user__: Optional[dict]
     ) -> Optional[dict]:
@@ -107,55 +563,50 @@ class Filter:
         messages = body["messages"]
         user_message = get_last_user_message(messages)
 
-        all_knowledge_bases = Knowledges.get_knowledge_bases_by_user_id(
-            __user__.get("id"), "read"
-        )
-
-        knowledge_bases_list = "\n\n".join(
-            [
-                f"--- Knowledge Base {index + 1} ---\n"
-                f"ID: {getattr(knowledge_base, 'id', 'Unknown')}\n"
-                f"Name: {getattr(knowledge_base, 'name', 'Unknown')}\n"
-                f"Description: {getattr(knowledge_base, 'description', 'Unknown')}"
-                for index, knowledge_base in enumerate(all_knowledge_bases)
-            ]
-        )
-
-        system_prompt = f"""You are a system that selects the most appropriate knowledge bases for the user's query.
-Below is a list of knowledge bases accessible by the user. 
-Based on the user's prompt, return the 1-3 most relevant knowledge bases as an array. 
-If no relevant knowledge bases are applicable, return an "None" without any explanation.
-
-Available knowledge bases:
-{knowledge_bases_list}
+        (
+            knowledge_bases,
+            knowledge_bases_list,
+            kb_ids_hash,
+            knowledge_bases_loaded,
+        ) = get_knowledge_bases_cached(__user__.get("id"), "read")
+
+        # With no knowledge bases there is nothing to choose from, so skip the LLM.
+        # With exactly one, skipping the LLM means it is attached to every message (even
+        # unrelated ones), so that is only done when `auto_select_single_knowledge_base` is on.
+        if not knowledge_bases or (
+            len(knowledge_bases) == 1 and self.valves.auto_select_single_knowledge_base
+        ):
+            return {
+                "result": {
+                    "selected_knowledge_bases": [
+                        {"id": knowledge_base.id, "name": knowledge_base.name}
+                        for knowledge_base in knowledge_bases.values()
+                    ]
+                },
+                "knowledge_bases": knowledge_bases,
+                "knowledge_bases_loaded": knowledge_bases_loaded,
+            }
 
-Return the result in the following JSON format (no extra keys, no explanations):
-{{
-    "selected_knowledge_bases": 
-        [
-            {{
-                "id": <KnowledgeBaseID>,
-                "name": <KnowledgeBaseName>
-            }},
-            ...
-        ]
-}}"""
+        system_prompt = self._kb_system_prompt_tpl.format(kb_list=knowledge_bases_list)
 
         prompt = (
             "History:\n"
             + "\n".join(
-                [
-                    f"{message['role'].upper()}: \"\"\"{message['content']}\"\"\""
-                    for message in messages[::-1][:4]
-                ]
+                f"{message['role'].upper()}: \"\"\"{message['content']}\"\"\""
+                for message in messages[-4:]
             )
             + f"\nUser query: {user_message}"
         )
 
+        model = self.valves.classifier_model
         return {
             "system_prompt": system_prompt,
             "prompt": prompt,
-            "model": "gpt-4o",
+            "model": model,
+            "llm_string": f"{model}|kb_selector_v1|{kb_ids_hash}|{hash_history(messages[-4:-1])}",
+            "none_result": {"selected_knowledge_bases": []},
+            "knowledge_bases": knowledge_bases,
+            "knowledge_bases_loaded": knowledge_bases_loaded,
         }
 
     async def determine_web_search_needed(
@@ -171,49 +622,30 @@ Return the result in the following JSON format (no extra keys, no explanations):
         messages = body["messages"]
         user_message = get_last_user_message(messages)
 
-        system_prompt = """You are a system that determines if a web search is needed for the user's query.
-
-Consider the following when making your decision:
-1. If the query relates to real-time or up-to-date information, including recurring events 
-   (e.g., a presidential inauguration, annual shareholder meetings, quarterly earnings reports, 
-   product launches, or company announcements), enable a web search to ensure the most recent 
-   occurrence is addressed.
-
-2. If the query is not about historical facts, assume most questions benefit from incorporating 
-   the latest information available through a web search.
-
-3. Particularly for questions regarding business or economic topics—such as company or 
-   industry trends, corporate information, related public figures, government policies, 
-   taxes, new technologies, and other fast-changing subjects—web search is strongly recommended 
-   to ensure accuracy and freshness of data.
-
-4. For general or everyday prompts that may require current information (e.g., weather updates, recent news, live events), enable a web search.
-
-5. Strive to make human-like judgments to ensure your decision aligns with the user's intent 
-   and the context of the question.
+        # Skip the LLM when keywords make the answer obvious
+        if self.valves.web_search_keyword_check and user_message:
+            web_search_enabled = guess_web_search_needed(user_message)
+            if web_search_enabled is not None:
+                return {"result": {"web_search_enabled": web_search_enabled}}
 
-6. If the user's query is not clear, return "None" without any explanation.
-
-Return the result in the following JSON format:
-{
-    "web_search_enabled": boolean
-}"""
+        system_prompt = self._ws_system_prompt
 
         prompt = (
             "History:\n"
             + "\n".join(
-                [
-                    f"{message['role'].upper()}: \"\"\"{message['content']}\"\"\""
-                    for message in messages[::-1][:4]
-                ]
+                f"{message['role'].upper()}: \"\"\"{message['content']}\"\"\""
+                for message in messages[-4:]
             )
             + f"\nUser query: {user_message}"
         )
 
+        model = self.valves.classifier_model
         return {
             "system_prompt": system_prompt,
             "prompt": prompt,
-            "model": "gpt-4o",
+            "model": model,
+            "llm_string": f"{model}|web_search_v1|{hash_history(messages[-4:-1])}",
+            "none_result": {"web_search_enabled": False},
         }
 
     async def inlet(
@@ -237,77 +669,56 @@ Return the result in the following JSON format:
             )
             user_object = UserModel(**user_data)
             user = Users.get_user_by_id(__user__["id"]) if __user__ else None
+            user_message = get_last_user_message(body["messages"])
 
             ###################################################################
-            # 1) Knowledge Base Selection
+            # 1) Knowledge Base Selection and Web Search Determination
+            #    (both classifiers are independent, so they run concurrently)
             ###################################################################
             kb_plan = await self.select_knowledge_base(body, __user__)
             if kb_plan is None:
                 raise ValueError("select_knowledge_base result is None")
 
-            kb_payload = {
-                "model": kb_plan["model"],
-                "messages": [
-                    {"role": "system", "content": kb_plan["system_prompt"]},
-                    {"role": "user", "content": kb_plan["prompt"]},
-                ],
-                "stream": False,
-            }
-            kb_response = await generate_chat_completion(
-                request=__request__, form_data=kb_payload, user=user
-            )
+            plans = [kb_plan]
+            if self.valves.auto_search_mode:
+                ws_plan = await self.determine_web_search_needed(body, __user__)
+                if ws_plan is None:
+                    raise ValueError("determine_web_search_needed result is None")
+                plans.append(ws_plan)
+
+            # Embed the user message once for all classifier cache lookups. The embedding runs
+            # alongside the classifiers, so it is usually ready before the cache is updated.
+            vector_task = None
+            if (
+                self.valves.cache_enabled
+                and user_message
+                and any("result" not in plan for plan in plans)
+            ):
+                app_state = getattr(getattr(__request__, "app", None), "state", None)
+                embed_fn = getattr(app_state, "EMBEDDING_FUNCTION", None)
+                if embed_fn is not None:
+                    vector_task = asyncio.ensure_future(
+                        _classifier_cache.aembed(user_message, embed_fn)
+                    )
 
-            kb_content = (
-                kb_response["choices"][0]["message"]["content"] if kb_response else ""
+            results = await asyncio.gather(
+                *(
+                    self.run_plan(plan, user_message, vector_task, __request__, user)
+                    for plan in plans
+                )
             )
-            print("kb_content start: =================================")
-            print(kb_content)
-            print("kb_content end: =================================")
 
-            if kb_content == "None":
-                selected_knowledge_bases = []
-            else:
-                try:
-                    kb_result = parse_json_content(kb_content)
-
-                    selected_knowledge_bases = (
-                        kb_result.get("selected_knowledge_bases", [])
-                        if kb_result
-                        else []
-                    )
-                except Exception as e:
-                    print(e)
-                    selected_knowledge_bases = []
+            kb_result = results[0]
+            selected_knowledge_bases = (
+                kb_result.get("selected_knowledge_bases", []) if kb_result else []
+            )
 
             ###################################################################
             # 2) Determining if Web Search is Needed
             ###################################################################
 
             if self.valves.auto_search_mode:
-                ws_plan = await self.determine_web_search_needed(body, __user__)
-                if ws_plan is None:
-                    raise ValueError("determine_web_search_needed result is None")
-
-                ws_payload = {
-                    "model": ws_plan["model"],
-                    "messages": [
-                        {"role": "system", "content": ws_plan["system_prompt"]},
-                        {"role": "user", "content": ws_plan["prompt"]},
-                    ],
-                    "stream": False,
-                }
-
-                ws_response = await generate_chat_completion(
-                    request=__request__, form_data=ws_payload, user=user
-                )
-
-                ws_content = (
-                    ws_response["choices"][0]["message"]["content"]
-                    if ws_response
-                    else ""
-                )
-                ws_result = parse_json_content(ws_content)
-
+                ws_result = results[1]
                 web_search_enabled = (
                     ws_result.get("web_search_enabled") if ws_result else False
                 )
@@ -323,37 +734,70 @@ Return the result in the following JSON format:
                         user_object,
                     )
                 else:
-                    print("No web search required.")
+                    log.debug("No web search required.")
 
             ###################################################################
             # If a matching Knowledge Base is found, add it to the body (merge with existing files)
             ###################################################################
 
+            # The knowledge bases are reused if they were loaded during this request. Otherwise the
+            # cached list (up to `_KB_CACHE_TTL` seconds old) is reloaded in a single query, so newly
+            # added files and revoked access take effect immediately.
+            available_knowledge_bases = kb_plan["knowledge_bases"]
+            if selected_knowledge_bases and not kb_plan["knowledge_bases_loaded"]:
+                available_knowledge_bases = get_knowledge_bases_cached(
+                    __user__.get("id"), "read", refresh=True
+                )[0]
+
+            selected_knowledge_base_infos = []
             selected_kb_names = []
             for selected_knowledge_base in selected_knowledge_bases:
                 kb_id = selected_knowledge_base.get("id")
                 kb_name = selected_knowledge_base.get("name")
 
                 if kb_id and kb_name:
-                    selected_kb_names.append(kb_name)
-                    selected_knowledge_base_info = Knowledges.get_knowledge_by_id(kb_id)
+                    selected_knowledge_base_info = available_knowledge_bases.get(kb_id)
 
                     if selected_knowledge_base_info:
-                        knowledge_file_ids = selected_knowledge_base_info.data.get(
-                            "file_ids", []
-                        )
-                        knowledge_files = Files.get_file_metadatas_by_ids(
-                            knowledge_file_ids
+                        selected_kb_names.append(kb_name)
+                        selected_knowledge_base_infos.append(
+                            selected_knowledge_base_info
                         )
-                        knowledge_dict = selected_knowledge_base_info.model_dump()
-                        knowledge_dict["files"] = [
-                            file.model_dump() for file in knowledge_files
-                        ]
-                        knowledge_dict["type"] = "collection"
 
-                        if "files" not in body:
-                            body["files"] = []
-                        body["files"].append(knowledge_dict)
+            all_file_ids = [
+                file_id
+                for selected_knowledge_base_info in selected_knowledge_base_infos
+                for file_id in (selected_knowledge_base_info.data or {}).get(
+                    "file_ids", []
+                )
+            ]
+            files_by_id = (
+                {
+                    file.id: file
+                    for file in Files.get_file_metadatas_by_ids(all_file_ids)
+                }
+                if all_file_ids
+                else {}
+            )
+
+            for selected_knowledge_base_info in selected_knowledge_base_infos:
+                knowledge_file_ids = (selected_knowledge_base_info.data or {}).get(
+                    "file_ids", []
+                )
+                knowledge_files = [
+                    files_by_id[file_id]
+                    for file_id in knowledge_file_ids
+                    if file_id in files_by_id
+                ]
+                knowledge_dict = selected_knowledge_base_info.model_dump(
+                    exclude={"user"}
+                )
+                knowledge_dict["files"] = _FILES_ADAPTER.dump_python(knowledge_files)
+                knowledge_dict["type"] = "collection"
+
+                if "files" not in body:
+                    body["files"] = []
+                body["files"].append(knowledge_dict)
 
             if selected_kb_names:
                 await self.emit_status(
@@ -371,7 +815,7 @@ Return the result in the following JSON format:
                 )
 
         except Exception as e:
-            print(e)
+            log.exception(e)
             await self.emit_status(
                 __event_emitter__,
                 level="status",
@@ -379,16 +823,7 @@ Return the result in the following JSON format:
                 done=True,
             )
 
-        context_message = {
-            "role": "system",
-            "content": (
-                "You are ChatGPT, a large language model trained by OpenAI. "
-                "Please ensure that all your responses are presented in a clear and organized manner using bullet points, numbered lists, headings, and other formatting tools to enhance readability and user-friendliness. "
-                "Additionally, please respond in the language used by the user in their input. "
-            ),
-        }
-        print("body start: =================================")
-        print(body)
-        print("body end: =================================")
-        body.setdefault("messages", []).insert(0, context_message)
+        log.debug("inlet body: %s", body)
+        # Copy, since later steps (e.g. RAG) update the system message content in place
+        body.setdefault("messages", []).insert(0, _CONTEXT_MESSAGE.copy())
         return body